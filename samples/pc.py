@@ -21,7 +21,7 @@ def main():
                 break
 
         try:
-            expr = pinas.Expression(expr_text, backend)
+            expr = backend.compile(expr_text)
             val = expr.eval(dict())
         except Exception as exc:
             print('Error:', str(exc))
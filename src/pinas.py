@@ -1,4 +1,4 @@
-import functools, io, token, tokenize, builtins, itertools
+import functools, token, builtins, itertools, re, collections, sys, keyword, array
 
 # Whitelists.
 # Select builtins and operator names that are always available.
@@ -25,9 +25,76 @@ known_unsafe_builtins = set([
     ])
 
 
-class PinasError(Exception): pass
+# Scanner.
+# Just enough of the Python lexical structure to find the names, attributes and operators in an
+# expression.  Anything that gets past this, but is still not a valid expression, is rejected by
+# the Python compiler.
+_String = '|'.join([
+    r"'''[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*'''",
+    r'"""[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*"""',
+    r"'[^\n'\\]*(?:\\.[^\n'\\]*)*'",
+    r'"[^\n"\\]*(?:\\.[^\n"\\]*)*"',
+    ])
+_Number = '|'.join([
+    r'0[xX](?:_?[0-9a-fA-F])+',
+    r'0[bB](?:_?[01])+',
+    r'0[oO](?:_?[0-7])+',
+    r'(?:\d(?:_?\d)*(?:\.(?:\d(?:_?\d)*)?)?|\.\d(?:_?\d)*)(?:[eE][-+]?\d(?:_?\d)*)?[jJ]?',
+    ])
+_Operator = '|'.join([
+    r'\*\*=?', r'//=?', r'>>=?', r'<<=?', r'->', r':=', r'\.\.\.',
+    r'[-+*/%@&|^<>=!]=',
+    r'[-+*/%@&|^~<>=()\[\]{},:;.]',
+    ])
+# String prefixes that don't interpolate anything.  A quote preceded by any other letters (f, t,
+# or whatever future Pythons come up with) is rejected, because the scanner can't see inside.
+_string_prefixes = frozenset(['r', 'u', 'b', 'br', 'rb'])
+_scan_re = re.compile('|'.join([
+    r'(?P<space>[ \t\f]+)',
+    r'(?P<nl>\r?\n|\r|\\\r?\n|\#[^\r\n]*)',
+    r'(?P<string>(?i:%s)?(?:%s))' % ('|'.join(sorted(_string_prefixes, key=len, reverse=True)), _String),
+    r'(?P<prefix>[^\W\d]\w*)(?=[\'"])',
+    r'(?P<name>[^\W\d]\w*)',
+    r'(?P<number>%s)' % (_Number,),
+    r'(?P<op>%s)' % (_Operator,),
+    r'(?P<error>.)',
+    ]), re.S)
+_TOKEN_NAME = token.NAME
+_TOKEN_NUMBER = token.NUMBER
+_TOKEN_STRING = token.STRING
+_TOKEN_OP = token.OP
+_TOKEN_NL = token.NL
+_TOKEN_ERR = token.ERRORTOKEN
+_scan_kinds = dict(nl=_TOKEN_NL, string=_TOKEN_STRING, name=_TOKEN_NAME, number=_TOKEN_NUMBER, op=_TOKEN_OP)
+
+# Operators ending in '=' that are not assignments.  (Plus '=' itself, which is checked separately.)
+_allowed_eq_ops = frozenset(['=', '==', '!=', '<=', '>='])
+
+# Expressions that are just a name or a number.
+_simple_expr_re = re.compile(r'[ \t\f\r\n]*(?:([^\W\d]\w*)|-?\d+(?:\.\d+)?)[ \t\f\r\n]*\Z')
+
+# The __builtins__ of every expression namespace, so that eval doesn't supply the real ones.
+# Shared by all expressions: must stay empty.
+_EMPTY_BUILTINS = {}
+
+# Max. number of results remembered per Expression, with Backend(cache_results=True).
+_EVAL_CACHE_SIZE = 256
+
+# Value types for which equal values always give the same result, so they can be used in a result
+# cache key.  (With the exception of float 0.0/-0.0, which is handled by keying on float.hex.)
+# Anything else, including containers and subclasses of these, bypasses the cache.
+_CACHEABLE_TYPES = frozenset([int, bool, str, bytes, float, type(None)])
+
+# A token.  Similar to tokenize.TokenInfo, minus the line.
+_Token = collections.namedtuple('_Token', ['type', 'string', 'start', 'end'])
+
+
+class PinasError(Exception):
+    __slots__ = ()
 
 class PinasNameError(PinasError):
+    __slots__ = ('names',)
+
     def __init__(self, names):
         self.names = names
 
@@ -38,14 +105,112 @@ class PinasNameError(PinasError):
             return "No value for names: %s" % (', '.join(self.names),)
 
 class PinasExpressionError(PinasError):
+    __slots__ = ('_tok', '_errtext')
+
     def __init__(self, tok, errtext):
         self._tok = tok
         self._errtext = errtext
 
     def __str__(self):
+        if self._tok is None:
+            return self._errtext
         return 'Line %d:%d: %s' % (self._tok.start[0], self._tok.start[1], self._errtext)
 
 
+def _token_at(text, kind, string, pos):
+    """!
+    @brief Make a _Token for string found at offset pos in text.
+    """
+    row = text.count('\n', 0, pos) + 1
+    col = pos - (text.rfind('\n', 0, pos) + 1)
+    return _Token(kind, string, (row, col), (row, col+len(string)))
+
+
+def _scan(expr):
+    """!
+    @brief Split an expression into tokens.
+    @param[in] expr	A str.
+    @return Generator of (kind, string, offset) tuples, where kind is a token.* constant.
+    Blanks are skipped; line breaks, comments and line continuations come out as token.NL.
+    """
+    kinds = _scan_kinds
+    for m in _scan_re.finditer(expr):
+        group = m.lastgroup
+        if group == 'space':
+            continue
+        if group == 'error':
+            raise PinasExpressionError(_token_at(expr, _TOKEN_ERR, m.group(), m.start()), 'Syntax error')
+        if group == 'prefix':
+            if m.group().lower() in _string_prefixes:
+                # An unterminated string.
+                raise PinasExpressionError(_token_at(expr, _TOKEN_ERR, m.group(), m.start()), 'Syntax error')
+            raise PinasExpressionError(_token_at(expr, _TOKEN_ERR, m.group(), m.start()),
+                                       'String prefix %s is not supported' % (m.group(),))
+        yield kinds[group], m.group(), m.start()
+
+
+def _parse(expr, backend):
+    """!
+    @brief Check an expression against the whitelists of a Backend, and extract identifiers.
+    @param[in] expr		A str with the text of the expression.
+    @param[in] backend	A Backend.
+    @return (unbound_names, net_expr): The set of names used other than as attributes, and the
+    expression text with line breaks and comments removed.
+    """
+    unbound_names = set()
+    available_named_parameter_names = set()
+    breaks = [] # (start, end) of the gaps that contain line breaks or comments.
+    prev_end = 0
+    prev_kind = prev_string = None
+    prev_is_dot = False
+    line_break = False
+    allow_methods = backend._allow_methods
+    npn_for = backend._named_parameter_names_for
+    unbound_add = unbound_names.add
+    intern = sys.intern
+    params_update = available_named_parameter_names.update
+    for kind, string, pos in _scan(expr):
+        if kind==_TOKEN_NL:
+            line_break = True
+            continue
+        if line_break:
+            breaks.append((prev_end, pos))
+            line_break = False
+        if kind==_TOKEN_NAME:
+            if prev_is_dot:
+                if string not in allow_methods:
+                    raise PinasExpressionError(_token_at(expr, kind, string, pos), 'Illegal method .%s' % (string,))
+            else:
+                params_update(npn_for.get(string, ()))
+                unbound_add(intern(string))
+        elif kind==_TOKEN_OP and string[-1]=='=':
+            if string=='=':
+                if prev_kind==_TOKEN_NAME:
+                    if prev_string not in available_named_parameter_names:
+                        raise PinasExpressionError(_token_at(expr, kind, string, pos),
+                                                   'No such named parameter: %s' % (prev_string,))
+                else:
+                    raise PinasExpressionError(_token_at(expr, kind, string, pos), 'Syntax error')
+            elif string not in _allowed_eq_ops:
+                # Assignments are banned, but only ':=' is really needed, because other versions are
+                # not legal in expressions, only statements.
+                # '=' is needed for named parameters.
+                raise PinasExpressionError(_token_at(expr, kind, string, pos), 'Illegal operator %s' % (string,))
+        prev_end = pos + len(string)
+        prev_kind = kind
+        prev_string = string
+        prev_is_dot = string=='.' # Only an operator can be a lone '.'.
+
+    # Slice the tokens out of the original text, with each line-breaking gap replaced by a space.
+    parts = []
+    start = 0
+    for gap_start, gap_end in breaks:
+        parts.append(expr[start:gap_start])
+        start = gap_end
+    parts.append(expr[start:prev_end])
+    return unbound_names, ' '.join(parts).lstrip()
+
+
 def NamedParameterNames(fn):
     """!
     @brief Get names available to use as named parameters.
@@ -74,14 +239,16 @@ def ImpliedArguments(fn):
         else:
             return ()
 
-def SupplyImpliedArguments(fn, namespace):
+def SupplyImpliedArguments(fn, namespace, iargs=None):
     """!
     @brief Supply values from namespace to keyword-only no-default arguments.
     @param[in] fn		A function.
     @param[in] namespace	A dict(str => ..)
+    @param[in] iargs	Optionally, ImpliedArguments(fn), if already known.
     @return fn wrapped to get arguments from namespace.
     """
-    iargs = ImpliedArguments(fn)
+    if iargs is None:
+        iargs = ImpliedArguments(fn)
     if len(iargs)==0:
         return fn
     else:
@@ -100,15 +267,25 @@ class Backend:
     """!
     @brief The context for expression evaluation.
     """
+    __slots__ = ('_allow_methods', '_allow_keywords', '_cache_results', '_allow_keywords_and_methods',
+                 'predefined_names', '_predef_or_kwm', '_module_functions', '_implied_args_for',
+                 '_SupplyImpliedArguments_for', 'predefined_functions', '_named_parameter_names_for',
+                 '_compile_cached', '__weakref__')
+
     def __init__(self,
                  module,
                  allow_builtin_names=None,
                  allow_keywords=None,
                  allow_methods=None,
+                 cache_results=False,
                  ):
         """!
         @param[in] module	A module. module.__all__ is a list of functions available to expressions.
         @param[in] allow_*	Optionally, override which builtins and methods names are considered safe.
+        @param[in] cache_results	If true, Expression.eval remembers results for recently seen values of
+        the free variables.  Only use this when the backing module functions have no side effects and
+        return the same value for the same arguments, and don't modify the returned values.
+        Only values of plain int, bool, str, bytes, float and None are cached on.
         """
         if allow_builtin_names is None:
             allow_builtin_names = default_allow_builtin_names
@@ -120,14 +297,20 @@ class Backend:
         if allow_methods is None:
             allow_methods = default_allow_methods
 
-        self._allow_methods = allow_methods
+        # Names are interned, as are the names in compiled code, so that dict and set lookups
+        # can match on identity.
+        intern = sys.intern
+        self._allow_methods = frozenset(intern(m) for m in allow_methods)
         self._allow_keywords = allow_keywords
-        self._allow_keywords_and_methods = allow_keywords | allow_methods
-        self.predefined_names = set(module.__all__) | allow_builtin_names
+        self._cache_results = cache_results
+        self._allow_keywords_and_methods = frozenset(intern(k) for k in allow_keywords) | self._allow_methods
+        self.predefined_names = frozenset(intern(n) for n in itertools.chain(module.__all__, allow_builtin_names))
+        self._predef_or_kwm = self.predefined_names | self._allow_keywords_and_methods
         self._module_functions = dict((n,getattr(module,n)) for n in module.__all__)
-        self._SupplyImpliedArguments_for = [(n,fn)
+        self._implied_args_for = dict((n,ImpliedArguments(fn)) for n,fn in self._module_functions.items())
+        self._SupplyImpliedArguments_for = [(n,fn,self._implied_args_for[n])
                                             for n,fn in self._module_functions.items()
-                                            if len(ImpliedArguments(fn)) > 0]
+                                            if len(self._implied_args_for[n]) > 0]
         self.predefined_functions = dict(self._module_functions)
         for k,v in allow_builtin_functions.items():
             if k not in self._module_functions:
@@ -137,110 +320,138 @@ class Backend:
         for n,fn in itertools.chain(allow_builtin_functions.items(), self._module_functions.items()):
             # Disallow named parameters that start with '_'.  Technically no need to do that, but
             # there probably was a reason for the underscore,
-            allowed_named_params = set(n for n in NamedParameterNames(fn) if not n.startswith('_'))
-            self._named_parameter_names_for[n] = allowed_named_params - set(ImpliedArguments(fn))
+            # (Builtins have no implied arguments.  When a module function shadows a builtin,
+            # the module function comes last and its entry wins.)
+            implied = self._implied_args_for.get(n, ())
+            self._named_parameter_names_for[n] = tuple(p for p in NamedParameterNames(fn)
+                                                       if not p.startswith('_') and p not in implied)
+
+        # Parsed expressions, by expression text.  Kept per backend, because the same text may
+        # parse differently under a different whitelist.
+        self._compile_cached = functools.lru_cache(maxsize=1024)(functools.partial(Expression, backend=self))
+
+    def compile(self, expr):
+        """!
+        @brief Get an Expression for expr, reusing an earlier one if the same text was seen recently.
+        @param[in] expr		A str with the text of the expression.
+        @return An Expression.  The same object may be returned for repeated calls, so don't modify it.
+        """
+        return self._compile_cached(expr)
 
 
 class Expression:
+    __slots__ = ('_backend', 'expr', '_net_tok_types', '_net_tok_strings', '_net_tok_positions', '_code',
+                 'predefined_names', 'free_variables', '_free_variables_tuple', '_eval_cache',
+                 '_base_namespace', '_implied', '_ambiguous', '_fn', '__weakref__')
+
     def __init__(self, expr, backend):
         """!
         @brief A Python expression.
         @param[in] expr		A str with the text of the expression.
         @param[in] backend	A Backend in which to evaluate it.
         @par
-        If a syntax error in expr is detected then an PinasExpressionError is raised, but it
-        might not the detected until .eval time.
+        If a syntax error in expr is detected then an PinasExpressionError is raised.
         """
         self._backend = backend
 
         # Extract identifiers from the expression.
         # Also, remove newlines, so that the expression may span multiple lines without parentheses.
-        unbound_names = set()
-        used_named_params = set()
-        available_named_parameter_names = set()
-        net_expr = []
-        net_toks = []
-        prev_end = (1, 0)
-        prev = None
-        for tok in tokenize.generate_tokens(io.StringIO(expr).readline):
-            if tok.start != prev_end:
-                if tok.start[0]==prev_end[0]:
-                    net_expr.append(' '*(tok.start[1]-prev_end[1]))
-                else:
-                    net_expr.append('  ')
-            if tok.type==token.NAME:
-                if prev is not None and prev.string=='.':
-                    if tok.string not in self._backend._allow_methods:
-                        raise PinasExpressionError(tok, 'Illegal method .%s' % (tok.string,))
-                else:
-                    available_named_parameter_names.update(backend._named_parameter_names_for.get(tok.string, ()))
-                    unbound_names.add(tok.string)
-            elif tok.type==token.ERRORTOKEN:
-                raise PinasExpressionError(tok, 'Syntax error')
-            elif tok.type==token.OP and tok.string[-1]=='=':
-                if tok.string=='=':
-                    if prev is not None and prev.type==token.NAME:
-                        if prev.string not in available_named_parameter_names:
-                            raise PinasExpressionError(tok, 'No such named parameter: %s' % (prev.string,))
-                        used_named_params.add(prev.string)
-
-                    else:
-                        raise PinasExpressionError(tok, 'Syntax error')
-                elif tok.string not in ['=','==','!=','<=','>=']:
-                    # Assignments are banned, but only ':=' is really needed, because other versions are
-                    # not legal in expressions, only statements.
-                    # '=' is needed for named parameters.
-                    raise PinasExpressionError(tok, 'Illegal operator %s' % (tok.string,))
-            if tok.type in [token.COMMENT, token.NEWLINE, token.INDENT, token.DEDENT, token.ENDMARKER, token.NL]:
-                pass
-            else:
-                net_toks.append(tok)
-                net_expr.append(tok.string)
-                prev_end = tok.end
-                prev = tok
-
-        self.expr = ''.join(net_expr).strip()
-        self._net_tokens = net_toks
+        m = _simple_expr_re.match(expr)
+        if m is not None:
+            # Just a name or a number; no need to scan.
+            name = m.group(1)
+            unbound_names = set() if name is None else set([sys.intern(name)])
+            self.expr = m.group(0).strip()
+        else:
+            unbound_names, self.expr = _parse(expr, backend)
+        self._net_tok_strings = None # Computed on demand by net_tokens().
+        try:
+            self._code = compile(self.expr, '<pinas>', 'eval')
+        except SyntaxError as exc:
+            # The compiler's position refers to .expr, not to the text we were given, so leave it out.
+            raise PinasExpressionError(None, 'Syntax error: %s' % (exc.msg,))
 
-        self.predefined_names = (unbound_names & backend.predefined_names) - backend._allow_keywords_and_methods
-        self.free_variables = unbound_names - backend.predefined_names - backend._allow_keywords_and_methods
+        self.predefined_names = unbound_names & backend.predefined_names
+        self.predefined_names -= backend._allow_keywords_and_methods
+        self.free_variables = unbound_names - backend._predef_or_kwm
 
-        for n,fn in backend._SupplyImpliedArguments_for:
+        for n,fn,iargs in backend._SupplyImpliedArguments_for:
             if n in self.predefined_names:
-                for implied_arg in ImpliedArguments(fn):
+                for implied_arg in iargs:
                     if implied_arg in backend.predefined_names:
                         self.predefined_names.add(implied_arg)
                     else:
                         self.free_variables.add(implied_arg)
+        self._free_variables_tuple = tuple(sorted(self.free_variables))
+
+        if backend._cache_results:
+            self._eval_cache = collections.OrderedDict()
+        else:
+            self._eval_cache = None
+
+        predefined_functions = backend.predefined_functions
+        self._base_namespace = {'__builtins__': _EMPTY_BUILTINS,
+                                **{n:predefined_functions[n] for n in self.predefined_names}}
 
-        self._base_namespace = dict(__builtins__=dict())
-        for n in self.predefined_names:
-            self._base_namespace[n] = backend.predefined_functions[n]
+        # The functions with implied arguments that this expression uses.
+        self._implied = [(n,fn,iargs)
+                         for n,fn,iargs in backend._SupplyImpliedArguments_for
+                         if n in self.predefined_names]
+
+        # Free variables that would clash with a predefined name.
+        self._ambiguous = sorted(self.free_variables.intersection(self._base_namespace))
+
+        self._fn = None # Made on demand by eval_fast().
 
 
 
     def net_tokens(self):
         """!
         @return The expression as Python tokens, excluding whitespace and comments.
+        Token positions are (row, column) in .expr.  .expr has no line breaks between tokens, but a
+        triple-quoted string may span lines.
+        Each call returns a new list.
         """
-        return self._net_tokens
+        if self._net_tok_strings is None:
+            # Kept as parallel arrays, which take up much less space than a list of _Token's.
+            types = array.array('B')
+            strings = []
+            positions = array.array('i')
+            for kind, string, pos in _scan(self.expr):
+                types.append(kind)
+                strings.append(string)
+                positions.append(pos)
+            self._net_tok_types = types
+            self._net_tok_positions = positions
+            self._net_tok_strings = strings
+        tokens = []
+        row = 1
+        line_start = 0
+        for kind, string, pos in zip(self._net_tok_types, self._net_tok_strings, self._net_tok_positions):
+            start = (row, pos - line_start)
+            nl = string.rfind('\n')
+            if nl >= 0:
+                row += string.count('\n')
+                line_start = pos + nl + 1
+            tokens.append(_Token(kind, string, start, (row, pos + len(string) - line_start)))
+        return tokens
 
     def effective_namespace(self, namespace):
         """!
         @param[in] namespace	A dict(str => ...) with values for free variables.
         @return A dict(str => ...) with the globals() environment for eval'ing the expression.
         """
-        eff_namespace = self._base_namespace.copy()
-        for n in self.free_variables:
-            if n in eff_namespace:
-                raise ValueError("'%s' is ambiguous" % (n,))
+        if self._ambiguous:
+            raise ValueError("'%s' is ambiguous" % (self._ambiguous[0],))
+        overlay = dict()
+        for n in self._free_variables_tuple:
             try:
-                eff_namespace[n] = namespace[n]
+                overlay[n] = namespace[n]
             except KeyError:
                 pass
-        for n,fn in self._backend._SupplyImpliedArguments_for:
-            if n in eff_namespace:
-                eff_namespace[n] = SupplyImpliedArguments(fn, eff_namespace)
+        eff_namespace = {**self._base_namespace, **overlay}
+        for n,fn,iargs in self._implied:
+            eff_namespace[n] = SupplyImpliedArguments(fn, eff_namespace, iargs)
         return eff_namespace
 
     def eval(self, namespace):
@@ -250,14 +461,87 @@ class Expression:
         @return The computed value.
         An PinasNameError exception arises if any free variables are unsatisfied.
         """
+        cache = self._eval_cache
+        if cache is None:
+            return self._eval(namespace)
+        # The type is part of the key, because e.g. 1, 1.0 and True are equal, but str() them
+        # and you get different results.  For the same reason, floats are keyed on their exact
+        # representation, so that 0.0 and -0.0 differ.
+        key = []
+        for n in self._free_variables_tuple:
+            try:
+                v = namespace[n]
+            except KeyError:
+                continue
+            t = type(v)
+            if t not in _CACHEABLE_TYPES:
+                return self._eval(namespace)
+            key.append((n, t, v.hex() if t is float else v))
+        key = tuple(key)
+        try:
+            value = cache[key]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(key)
+            return value
+        value = self._eval(namespace)
+        cache[key] = value
+        if len(cache) > _EVAL_CACHE_SIZE:
+            cache.popitem(last=False)
+        return value
+
+    def eval_fast(self, namespace):
+        """!
+        @brief Same as eval, but faster for an expression that is evaluated many times.
+        @param[in] namespace	dict(str => value) with values for free variables.
+        @return The computed value.
+        The first call compiles the expression into a function taking the free variables as
+        arguments; later calls just call it.  Falls back to eval when that isn't possible.
+        """
+        fn = self._fn
+        if fn is None:
+            fn = self._fn = self._make_fn()
+        if fn:
+            try:
+                args = [namespace[n] for n in self._free_variables_tuple]
+            except KeyError:
+                # Let eval sort out if anything is really missing.
+                pass
+            else:
+                return fn(*args)
+        return self.eval(namespace)
+
+    def _make_fn(self):
+        """!
+        @return A function computing the expression from the free variables as positional arguments,
+        in _free_variables_tuple order.  Or False if this expression can't be done that way.
+        """
+        if self._implied or self._ambiguous or self._eval_cache is not None:
+            # Implied arguments need the full namespace; cached results are served by eval.
+            return False
+        fvs = self._free_variables_tuple
+        if not all(n.isidentifier() and not keyword.iskeyword(n) for n in fvs):
+            return False
+        src = 'def _f(%s):\n    return %s\n' % (', '.join(fvs), self.expr)
+        try:
+            code = compile(src, '<pinas>', 'exec')
+        except SyntaxError:
+            # Names that are valid in an expression but not as parameters, such as __debug__.
+            return False
+        ns_local = dict()
+        exec(code, self._base_namespace, ns_local)
+        return ns_local['_f']
+
+    def _eval(self, namespace):
         eff_namespace = self.effective_namespace(namespace)
         try:
-            return eval(self.expr, eff_namespace)
+            return eval(self._code, eff_namespace)
         except NameError as exc:
-            missing = set(ident for ident in self.free_variables if ident not in namespace)
+            missing = [ident for ident in self._free_variables_tuple if ident not in namespace]
             if getattr(exc, 'name', None) in missing:
                 # If the expression contains code like "foo if baz else bar", then 'missing' may
                 # contain additional names that are not actually needed.  But in the typical case,
                 # listing all unbound identifiers is more helpful.
-                raise PinasNameError(missing)
+                raise PinasNameError(set(missing))
             raise
@@ -1,4 +1,4 @@
-import sys, unittest, builtins
+import sys, unittest, builtins, threading, collections, weakref
 sys.path.insert(0, '../src')
 import pinas
 
@@ -54,6 +54,12 @@ class Test_Cond(unittest.TestCase):
     def test_literals(self):
         self._test_ex("(2**4 - 10) / 2", 3)
 
+    def test_simple(self):
+        self._test_ex(" d\n", 3)
+        self._test_ex("-2.5", -2.5)
+        self._raises_PinasExpressionError("and")
+        self.assertEqual(pinas.Expression("add_d", backend).free_variables, set(['d']))
+
     def test_2plus2(self):
         self._test_ex("c+c", 4)
 
@@ -105,6 +111,174 @@ class Test_Cond(unittest.TestCase):
     def test_named_parameters_separate_with_implied(self):
         self._test_ex("implied_name_collision(a='a')", ('a', 1))
 
+    def test_implied_per_eval(self):
+        expr = pinas.Expression("implied('x')", backend)
+        self.assertEqual(expr.eval(dict(b=1)), ('x', 1))
+        self.assertEqual(expr.eval(dict(b=2)), ('x', 2))
+        self.assertRaises(pinas.PinasNameError, lambda:expr.eval(dict()))
+
+    def test_implied_lazy(self):
+        expr = pinas.Expression("(add_d(x) for x in [10, 20])", backend)
+        gen = expr.eval(dict(d=1))
+        expr.eval(dict(d=100))
+        self.assertEqual(list(gen), [11, 21])
+
+    def test_implied_other_thread(self):
+        expr = pinas.Expression("(add_d(x) for x in [10, 20])", backend)
+        gen = expr.eval(dict(d=1))
+        got = []
+        thread = threading.Thread(target=lambda:got.append(next(gen)))
+        thread.start()
+        thread.join()
+        self.assertEqual(got, [11])
+
+    def test_multiline(self):
+        self._test_ex("add(b,  # first\n d)\n + \\\n c", 6)
+
+    def test_names_in_strings(self):
+        expr = pinas.Expression("'open . x' + \"\"\"a.b\nc\"\"\"", backend)
+        self.assertEqual(expr.free_variables, set())
+        self.assertEqual(expr.eval(dict()), 'open . xa.b\nc')
+
+    def test_fstring(self):
+        self._raises_PinasExpressionError("f'{a.__class__}'")
+
+    def test_string_prefixes(self):
+        self._test_ex("Rb'\\x' + B\"y\"", b'\\xy')
+        for prefix in ['t', 'rt', 'Tr', 'fR', 'xyz']:
+            with self.assertRaises(pinas.PinasExpressionError) as cm:
+                pinas.Expression(prefix + "'{().__class__}'", backend)
+            self.assertIn('prefix', str(cm.exception))
+        self._raises_PinasExpressionError("b'unterminated")
+
+    def test_stray_character(self):
+        self._raises_PinasExpressionError("a $ b")
+
+    def test_net_tokens(self):
+        expr = pinas.Expression("add(b, # comment\n d)", backend)
+        self.assertEqual(expr.expr, "add(b, d)")
+        self.assertEqual([t.string for t in expr.net_tokens()], ['add', '(', 'b', ',', 'd', ')'])
+        self.assertEqual(expr.net_tokens()[4].start, (1, 7))
+        self.assertEqual(expr.net_tokens(), expr.net_tokens())
+
+    def test_net_tokens_multiline_string(self):
+        expr = pinas.Expression("'''a\nb''' + c", backend)
+        string, plus, c = expr.net_tokens()
+        self.assertEqual((string.start, string.end), ((1, 0), (2, 4)))
+        self.assertEqual(c.start, (2, 7))
+
+    def test_syntax_error(self):
+        self._raises_PinasExpressionError("add(b, d")
+        self._raises_PinasExpressionError("b d")
+        with self.assertRaises(pinas.PinasExpressionError) as cm:
+            pinas.Expression("add(b,\n  d) )", backend)
+        self.assertEqual(str(cm.exception), "Syntax error: unmatched ')'")
+
+
+class Test_Compile(unittest.TestCase):
+    def test_reused(self):
+        expr = backend.compile('add(b, d)')
+        self.assertIs(backend.compile('add(b, d)'), expr)
+        self.assertEqual(expr.eval(dict(b=1, d=3)), 4)
+
+    def test_per_backend(self):
+        other_backend = pinas.Backend(module=module)
+        self.assertIsNot(other_backend.compile('c+c'), backend.compile('c+c'))
+
+    def test_weakref(self):
+        expr = pinas.Expression('c+c', backend)
+        self.assertIs(weakref.ref(expr)(), expr)
+        self.assertIs(weakref.ref(backend)(), backend)
+
+    def test_error_not_cached(self):
+        self.assertRaises(pinas.PinasExpressionError, lambda:backend.compile('1 . bit_length()'))
+        self.assertRaises(pinas.PinasExpressionError, lambda:backend.compile('1 . bit_length()'))
+
+
+class Test_EvalFast(unittest.TestCase):
+    def test_free_variables(self):
+        expr = pinas.Expression('add(b, d) * c', backend)
+        self.assertEqual(expr.eval_fast(dict(b=1, d=3, c=2)), 8)
+        self.assertEqual(expr.eval_fast(dict(b=2, d=3, c=2, x=0)), 10)
+
+    def test_missing(self):
+        expr = pinas.Expression('add(b, d)', backend)
+        self.assertRaises(pinas.PinasNameError, lambda:expr.eval_fast(dict(b=1)))
+
+    def test_comprehension(self):
+        expr = pinas.Expression('sum(x*c for x in range(3))', backend)
+        self.assertEqual(expr.eval_fast(dict(c=2)), 6)
+
+    def test_implied(self):
+        expr = pinas.Expression('add_d(10)', backend)
+        self.assertEqual(expr.eval_fast(dict(d=3)), 13)
+        self.assertEqual(expr.eval_fast(dict(d=4)), 14)
+
+    def test_missing_method(self):
+        expr = pinas.Expression('a+1', backend)
+        self.assertEqual(expr.eval(collections.defaultdict(int)), 1)
+        self.assertEqual(expr.eval_fast(collections.defaultdict(int)), 1)
+
+    def test_no_builtins(self):
+        expr = pinas.Expression('open', backend)
+        self.assertRaises(pinas.PinasNameError, lambda:expr.eval_fast(dict()))
+
+    def test_not_a_parameter_name(self):
+        expr = pinas.Expression('c + __debug__', backend)
+        self.assertEqual(expr.eval_fast(dict(c=2)), 3)
+        self.assertEqual(expr.eval_fast(dict(c=3)), 4)
+
+
+class Test_CacheResults(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        class counting_module:
+            __all__ = ['count']
+            @staticmethod
+            def count(x):
+                self.calls.append(x)
+                return str(x)
+        self.backend = pinas.Backend(module=counting_module, cache_results=True)
+
+    def test_cached(self):
+        expr = pinas.Expression('count(a)', self.backend)
+        self.assertEqual(expr.eval(dict(a=1)), '1')
+        self.assertEqual(expr.eval(dict(a=1, b=2)), '1')
+        self.assertEqual(self.calls, [1])
+
+    def test_equal_values_of_different_type(self):
+        expr = pinas.Expression('count(a)', self.backend)
+        self.assertEqual(expr.eval(dict(a=1)), '1')
+        self.assertEqual(expr.eval(dict(a=1.0)), '1.0')
+        self.assertEqual(expr.eval(dict(a=True)), 'True')
+
+    def test_negative_zero(self):
+        expr = pinas.Expression('count(a)', self.backend)
+        self.assertEqual(expr.eval(dict(a=0.0)), '0.0')
+        self.assertEqual(expr.eval(dict(a=-0.0)), '-0.0')
+
+    def test_equal_containers(self):
+        expr = pinas.Expression('count(a)', self.backend)
+        self.assertEqual(expr.eval(dict(a=(1,))), '(1,)')
+        self.assertEqual(expr.eval(dict(a=(1.0,))), '(1.0,)')
+
+    def test_decimal(self):
+        import decimal
+        expr = pinas.Expression('count(a)', self.backend)
+        self.assertEqual(expr.eval(dict(a=decimal.Decimal('1'))), '1')
+        self.assertEqual(expr.eval(dict(a=decimal.Decimal('1.0'))), '1.0')
+
+    def test_unhashable(self):
+        expr = pinas.Expression('count(a)', self.backend)
+        self.assertEqual(expr.eval(dict(a=[1])), '[1]')
+        self.assertEqual(expr.eval(dict(a=[1])), '[1]')
+        self.assertEqual(self.calls, [[1], [1]])
+
+    def test_missing_not_cached(self):
+        expr = pinas.Expression('count(a)', self.backend)
+        self.assertRaises(pinas.PinasNameError, lambda:expr.eval(dict()))
+        self.assertRaises(pinas.PinasNameError, lambda:expr.eval(dict()))
+
 
 class Test_ImpliedArguments(unittest.TestCase):
     def test_builtins_no_matches(self):